@@ -166,7 +166,8 @@ export default function Home() {
 
       let data: ChatResponse;
       try {
-        data = JSON.parse(rawData.response);
+        // Le serveur renvoie désormais un objet ; on accepte encore l'ancien format chaîne
+        data = typeof rawData.response === 'string' ? JSON.parse(rawData.response) : rawData.response;
       } catch (parseError) {
         console.error('Erreur de parsing de rawData.response:', parseError);
         throw new Error('Format de réponse invalide');
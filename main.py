@@ -90,5 +90,12 @@ async def query_endpoint(query: Query):
         raise HTTPException(status_code=500, detail=str(e))
     
 if __name__ == "__main__":
+    import os
     import uvicorn
-    uvicorn.run("main:app", host="localhost", port=8000, reload=True)
\ No newline at end of file
+    # default asyncio loop: nest_asyncio cannot patch uvloop; auto-reload only when explicitly requested
+    uvicorn.run(
+        "main:app",
+        host="localhost",
+        port=8000,
+        reload=os.getenv("RELOAD") == "1"
+    )
\ No newline at end of file
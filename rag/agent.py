@@ -1,3 +1,4 @@
+import asyncio
 from typing import Dict, List
 from typing import List, Optional, Any
 from llama_index.core.tools import BaseTool
@@ -16,24 +17,25 @@ from llama_index.core.workflow import (
     step,
 )
 
+# Static system block kept at the head of the history so the prompt prefix stays cacheable
+SYSTEM_PROMPT_STATIC = (
+    "You are a knowledge management assistant for consultants. "
+    "Answer questions about the consulting presentations indexed in the knowledge base "
+    "by calling the query_workflow tool, and base your answers on the retrieved content."
+)
+
 
 class InputEvent(Event):
     """Input event."""
 
+    # passed on to the RAG workflow to bypass its response cache
+    no_cache: bool = False
+
 class GatherToolsEvent(Event):
     """Gather Tools Event"""
 
     tool_calls: Any
-
-class ToolCallEvent(Event):
-    """Tool Call event"""
-
-    tool_call: ToolSelection
-
-class ToolCallEventResult(Event):
-    """Tool call event result."""
-
-    msg: ChatMessage
+    no_cache: bool = False
 
 
 class RouterOutputAgentWorkflow(Workflow):
@@ -60,13 +62,34 @@ class RouterOutputAgentWorkflow(Workflow):
         self.rag_workflow_tool = FunctionTool.from_defaults(query_workflow)
 
         self.llm: LLM = llm or OpenAI(temperature=0, model="gpt-4o")
-        self.chat_history: List[ChatMessage] = chat_history or []
+        self.chat_history: List[ChatMessage] = self._with_system_prompt(chat_history or [])
+
+        # RAG runs in flight, keyed by tool kwargs, shared by identical tool calls
+        self._inflight: Dict[frozenset, asyncio.Future] = {}
+
+    @staticmethod
+    def _with_system_prompt(chat_history: List[ChatMessage]) -> List[ChatMessage]:
+        """Seeds the history with the static system prompt, keeping dynamic content after it."""
 
+        if chat_history and chat_history[0].role == "system":
+            return chat_history
+        return [ChatMessage(role="system", content=SYSTEM_PROMPT_STATIC)] + chat_history
 
     def reset(self) -> None:
         """Resets Chat History"""
 
-        self.chat_history = []
+        self.chat_history = self._with_system_prompt([])
+
+    async def _run_rag_tool(self, tool_kwargs: Dict[str, Any]) -> Any:
+        """Runs the RAG workflow, sharing the result between identical concurrent calls."""
+
+        key = frozenset(tool_kwargs.items())
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.rag_workflow.run(**tool_kwargs))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
 
     @step()
     async def prepare_chat(self, ev: StartEvent) -> InputEvent:
@@ -77,7 +100,7 @@ class RouterOutputAgentWorkflow(Workflow):
         # add msg to chat history
         chat_history = self.chat_history
         chat_history.append(ChatMessage(role="user", content=message))
-        return InputEvent()
+        return InputEvent(no_cache=ev.get("no_cache", False))
 
     @step()
     async def chat(self, ev: InputEvent) -> GatherToolsEvent | StopEvent:
@@ -100,30 +123,14 @@ class RouterOutputAgentWorkflow(Workflow):
         # If no tool calls, directly run RAG workflow with the user's last message
         if not tool_calls:
             last_user_message = self.chat_history[-2].content  # Get the last user message
-            rag_response = await self.rag_workflow.run(query_str=last_user_message)
+            rag_response = await self.rag_workflow.run(query_str=last_user_message, no_cache=ev.no_cache)
             return StopEvent(result=f"{ai_message.content}\n\nRAG Response: {str(rag_response)}")
 
-        return GatherToolsEvent(tool_calls=tool_calls)
-
-    @step(pass_context=True)
-    async def dispatch_calls(self, ctx: Context, ev: GatherToolsEvent) -> ToolCallEvent:
-        """Dispatches calls."""
-
-        tool_calls = ev.tool_calls
-        await ctx.set("num_tool_calls", len(tool_calls))
-
-        # trigger tool call events
-        for tool_call in tool_calls:
-            ctx.send_event(ToolCallEvent(tool_call=tool_call))
+        return GatherToolsEvent(tool_calls=tool_calls, no_cache=ev.no_cache)
 
-        return None
-
-    @step()
-    async def call_tool(self, ev: ToolCallEvent) -> ToolCallEventResult:
+    async def _call_tool(self, tool_call: ToolSelection, no_cache: bool = False) -> ChatMessage:
         """Calls tool."""
 
-        tool_call = ev.tool_call
-
         # get tool ID and function call
         id_ = tool_call.tool_id
 
@@ -131,8 +138,8 @@ class RouterOutputAgentWorkflow(Workflow):
             print(f"Calling function {tool_call.tool_name} with msg {tool_call.tool_kwargs}")
 
         # directly run workflow, don't call tools
-        output = await self.rag_workflow.run(**tool_call.tool_kwargs)
-        msg = ChatMessage(
+        output = await self._run_rag_tool({**tool_call.tool_kwargs, "no_cache": no_cache})
+        return ChatMessage(
             name=tool_call.tool_name,
             content=str(output),
             role="tool",
@@ -142,19 +149,14 @@ class RouterOutputAgentWorkflow(Workflow):
             }
         )
 
-        return ToolCallEventResult(msg=msg)
+    @step()
+    async def run_tools(self, ev: GatherToolsEvent) -> InputEvent:
+        """Runs all tool calls concurrently and gathers their results."""
 
-    @step(pass_context=True)
-    async def gather(self, ctx: Context, ev: ToolCallEventResult) -> StopEvent | None:
-        """Gathers tool calls."""
-        # wait for all tool call events to finish.
-        tool_events = ctx.collect_events(ev, [ToolCallEventResult] * await ctx.get("num_tool_calls"))
-        if not tool_events:
-            return None
+        msgs = await asyncio.gather(*[self._call_tool(tool_call, ev.no_cache) for tool_call in ev.tool_calls])
 
-        for tool_event in tool_events:
-            # append tool call chat messages to history
-            self.chat_history.append(tool_event.msg)
+        # append tool call chat messages to history
+        self.chat_history.extend(msgs)
 
-        # # after all tool calls finish, pass input event back, restart agent loop
-        return InputEvent()
+        # after all tool calls finish, pass input event back, restart agent loop
+        return InputEvent(no_cache=ev.no_cache)
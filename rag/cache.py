@@ -0,0 +1,221 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable, List, Optional, Tuple
+
+import hnswlib
+import numpy as np
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+# Number of neighbours inspected per lookup, to skip entries from other namespaces
+LOOKUP_K = 10
+
+def _quantize(vector: np.ndarray) -> Tuple[np.ndarray, float]:
+    """Symmetric per-vector int8 quantization: vector ~= codes * scale."""
+    scale = float(np.abs(vector).max()) / 127 or 1.0
+    codes = np.round(vector / scale).astype(np.int8)
+    return codes, scale
+
+class SemanticCache:
+    """Caches final responses keyed by the embedding of the user query, persisted in SQLite.
+
+    At most max_size entries are kept; expired and oldest entries are evicted on insert.
+    With quantize=True (requires faiss), the HNSW graph keeps 8-bit scalar-quantized
+    vectors and SQLite stores int8 codes plus one scale per vector: 4x less memory per
+    entry, at the cost of a small similarity error. Check hit quality at your tau
+    before enabling.
+    """
+
+    def __init__(
+        self,
+        db_path: Optional[str] = None,
+        tau: float = 0.92,
+        ttl: float = 24 * 3600,
+        max_size: int = 10000,
+        quantize: bool = False
+    ):
+        self.db_path = db_path or os.path.join(os.path.dirname(__file__), 'semantic_cache.db')
+        self.tau = tau
+        self.ttl = ttl
+        self.max_size = max_size
+        self.quantize = quantize
+        if quantize and faiss is None:
+            raise ImportError("quantize=True requires faiss (pip install faiss-cpu)")
+
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        # writes run in worker threads, the connection must not be used concurrently
+        self._conn_lock = threading.Lock()
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS semantic_cache ("
+            " id INTEGER PRIMARY KEY,"
+            " namespace TEXT NOT NULL,"
+            " embedding BLOB NOT NULL,"
+            " response TEXT NOT NULL,"
+            " ts REAL NOT NULL,"
+            " scale REAL)"
+        )
+        # databases created before quantization support lack the scale column
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(semantic_cache)")]
+        if "scale" not in columns:
+            self.conn.execute("ALTER TABLE semantic_cache ADD COLUMN scale REAL")
+        self.conn.commit()
+
+        # (namespace, response, ts) by SQLite row id, oldest first; row ids are the HNSW labels
+        self._entries: "OrderedDict[int, Tuple[str, str, float]]" = OrderedDict()
+        self._index = None
+        # faiss cannot delete from HNSW: row id per faiss position, evicted ones are skipped
+        self._positions: List[int] = []
+        self._load()
+
+    def _load(self):
+        """Loads the newest non-expired entries from SQLite and drops the others."""
+        cutoff = time.time() - self.ttl
+        self.conn.execute("DELETE FROM semantic_cache WHERE ts < ?", (cutoff,))
+        self.conn.execute(
+            "DELETE FROM semantic_cache WHERE id NOT IN"
+            " (SELECT id FROM semantic_cache ORDER BY id DESC LIMIT ?)",
+            (self.max_size,)
+        )
+        self.conn.commit()
+        rows = self.conn.execute(
+            "SELECT id, namespace, embedding, response, ts, scale FROM semantic_cache ORDER BY id"
+        ).fetchall()
+        for row_id, namespace, embedding, response, ts, scale in rows:
+            # a NULL scale marks a float32 row, otherwise the blob holds int8 codes
+            if scale is None:
+                vector = np.frombuffer(embedding, dtype=np.float32)
+            else:
+                vector = np.frombuffer(embedding, dtype=np.int8).astype(np.float32) * scale
+            self._append(row_id, namespace, vector, response, ts)
+
+    def _append(self, row_id: int, namespace: str, embedding: np.ndarray, response: str, ts: float):
+        if self.quantize:
+            self._append_sq(row_id, embedding)
+        else:
+            self._append_index(row_id, embedding)
+        self._entries[row_id] = (namespace, response, ts)
+
+    def _append_index(self, row_id: int, embedding: np.ndarray):
+        if self._index is None:
+            self._index = hnswlib.Index(space='cosine', dim=embedding.shape[0])
+            self._index.init_index(
+                max_elements=min(1024, self.max_size), ef_construction=200, M=16, allow_replace_deleted=True
+            )
+            self._index.set_ef(50)
+        elif len(self._entries) >= self._index.get_max_elements():
+            # no deleted slot left to reuse; concurrent inserts may briefly exceed max_size
+            self._index.resize_index(2 * self._index.get_max_elements())
+
+        self._index.add_items(embedding[np.newaxis, :], [row_id], replace_deleted=True)
+
+    def _append_sq(self, row_id: int, embedding: np.ndarray):
+        if self._index is None:
+            dim = embedding.shape[0]
+            self._index = faiss.IndexHNSWSQ(dim, faiss.ScalarQuantizer.QT_8bit, 16, faiss.METRIC_INNER_PRODUCT)
+            self._index.hnsw.efConstruction = 200
+            self._index.hnsw.efSearch = 50
+            # unit vectors lie in [-1, 1] per component: fixed range, no training data needed
+            self._index.train(np.stack([-np.ones(dim, dtype=np.float32), np.ones(dim, dtype=np.float32)]))
+        self._index.add(embedding[np.newaxis, :])
+        self._positions.append(row_id)
+
+    def _rebuild_sq(self):
+        """Rebuilds the faiss index from the live entries once evicted ones dominate it."""
+        live = [(pos, row_id) for pos, row_id in enumerate(self._positions) if row_id in self._entries]
+        vectors = [self._index.reconstruct(pos) for pos, _ in live]
+        self._index.reset()
+        if vectors:
+            self._index.add(np.stack(vectors))
+        self._positions = [row_id for _, row_id in live]
+
+    def _evict(self, now: float) -> List[int]:
+        """Drops expired entries, then the oldest ones, to make room for one insert."""
+        cutoff = now - self.ttl
+        evicted = []
+        while self._entries:
+            row_id, (_, _, ts) = next(iter(self._entries.items()))
+            if ts >= cutoff and len(self._entries) < self.max_size:
+                break
+            del self._entries[row_id]
+            if not self.quantize:
+                self._index.mark_deleted(row_id)
+            evicted.append(row_id)
+        if self.quantize and len(self._positions) > 2 * len(self._entries):
+            self._rebuild_sq()
+        return evicted
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def _candidates(self, vector: np.ndarray):
+        """Yields (row id, cosine similarity) of the nearest entries, most similar first."""
+        if self.quantize:
+            k = min(LOOKUP_K, len(self._positions))
+            similarities, positions = self._index.search(vector[np.newaxis, :], k)
+            for pos, similarity in zip(positions[0], similarities[0]):
+                if pos >= 0:
+                    yield self._positions[pos], similarity
+        else:
+            k = min(LOOKUP_K, len(self._entries))
+            labels, distances = self._index.knn_query(vector, k=k)
+            for row_id, distance in zip(labels[0], distances[0]):
+                yield row_id, 1 - distance
+
+    def lookup(self, embedding, namespace: str = "default", tau: Optional[float] = None) -> Optional[str]:
+        """Returns the cached response of the most similar query, if its cosine similarity reaches tau."""
+        if not self._entries:
+            return None
+        tau = self.tau if tau is None else tau
+        cutoff = time.time() - self.ttl
+
+        for row_id, similarity in self._candidates(self._normalize(embedding)):
+            if similarity < tau:
+                break
+            entry = self._entries.get(row_id)
+            if entry is not None and entry[0] == namespace and entry[2] >= cutoff:
+                return entry[1]
+        return None
+
+    def _encode(self, embedding) -> Tuple[np.ndarray, bytes, Optional[float]]:
+        vector = self._normalize(embedding)
+        if self.quantize:
+            codes, scale = _quantize(vector)
+            return vector, codes.tobytes(), scale
+        return vector, vector.tobytes(), None
+
+    def _write(self, namespace: str, blob: bytes, response: str, ts: float, scale: Optional[float],
+               evicted: Iterable[int]) -> int:
+        """Persists one entry and deletes the evicted ones; returns the new row id."""
+        with self._conn_lock:
+            self.conn.executemany("DELETE FROM semantic_cache WHERE id = ?", [(row_id,) for row_id in evicted])
+            cursor = self.conn.execute(
+                "INSERT INTO semantic_cache (namespace, embedding, response, ts, scale) VALUES (?, ?, ?, ?, ?)",
+                (namespace, blob, response, ts, scale)
+            )
+            self.conn.commit()
+            return cursor.lastrowid
+
+    def insert(self, embedding, response: str, namespace: str = "default"):
+        """Stores a response for the given query embedding."""
+        vector, blob, scale = self._encode(embedding)
+        ts = time.time()
+        evicted = self._evict(ts)
+        row_id = self._write(namespace, blob, response, ts, scale, evicted)
+        self._append(row_id, namespace, vector, response, ts)
+
+    async def ainsert(self, embedding, response: str, namespace: str = "default"):
+        """Like insert, with the SQLite write and commit run in a worker thread."""
+        vector, blob, scale = self._encode(embedding)
+        ts = time.time()
+        evicted = self._evict(ts)
+        row_id = await asyncio.to_thread(self._write, namespace, blob, response, ts, scale, evicted)
+        self._append(row_id, namespace, vector, response, ts)
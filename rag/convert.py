@@ -1,135 +1,142 @@
-import json
-import re
-from typing import Dict, List, Optional
+import ast
+import logging
+import warnings
+import numpy as np
+import orjson
+from numba import njit
+from typing import Dict, List, Tuple
 
-def extract_last_response(input_text: str) -> str:
-    """Extrait le texte de la dernière balise <response> dans l'input."""
-    responses = re.findall(r'<response>(.*?)</response>', input_text, re.DOTALL)
-    return responses[-1].strip() if responses else ""
+logger = logging.getLogger(__name__)
 
-def clean_string(s: str) -> str:
-    """Nettoie une chaîne de caractères pour la rendre compatible JSON."""
-    # Remplace les guillemets simples par des guillemets doubles
-    s = s.replace("'", '"')
-    
-    try:
-        # Trouve le premier crochet ouvrant et le dernier crochet fermant
-        start = s.find('[')
-        end = s.rfind(']')
-        
-        if start != -1 and end != -1:
-            # Extrait le contenu entre les crochets
-            content = s[start:end+1]
-            
-            # Nettoie le contenu en ne gardant que les objets avec les champs requis
-            matches = re.finditer(r'{[^}]*"file_name"[^}]*"url"[^}]*"page"[^}]*}|{[^}]*"page"[^}]*"url"[^}]*"file_name"[^}]*}|{[^}]*"url"[^}]*"page"[^}]*"file_name"[^}]*}', content)
-            
-            cleaned_objects = []
-            for match in matches:
-                obj_str = match.group()
-                try:
-                    # Nettoie l'objet
-                    obj_str = re.sub(r',\s*"content":[^}]*', '', obj_str)  # Supprime le champ content
-                    obj = json.loads(obj_str)
-                    if all(key in obj for key in ['file_name', 'url', 'page']):
-                        cleaned_obj = {
-                            'file_name': obj['file_name'],
-                            'url': obj['url'],
-                            'page': obj['page']
-                        }
-                        cleaned_objects.append(cleaned_obj)
-                except:
-                    continue
-            
-            return json.dumps(cleaned_objects)
-            
-    except Exception as e:
-        print(f"Erreur dans clean_string: {e}")
+def _find_last_tag(input_text: str, tag: str) -> str:
+    """Renvoie le contenu de la dernière balise <tag>...</tag> complète, ou une chaîne vide."""
+    open_tag = f'<{tag}>'
+    end = input_text.rfind(f'</{tag}>')
+    if end == -1:
+        return ''
+    start = input_text.rfind(open_tag, 0, end)
+    if start == -1:
+        return ''
+    return input_text[start + len(open_tag):end]
+
+def _scan_last_tags(input_text: str) -> Tuple[str, str]:
+    """Renvoie le contenu des dernières balises <response> et <source>."""
+    # Délimiteurs littéraux : str.rfind suffit et ne parcourt que la fin du texte.
+    # Un moteur multi-motifs (Hyperscan) devrait encoder et parcourir tout l'input,
+    # alors qu'on ne cherche que les dernières balises.
+    return (
+        _find_last_tag(input_text, 'response').strip(),
+        _find_last_tag(input_text, 'source').strip()
+    )
+
+@njit(cache=True)
+def _find_objects(buf):
+    """Renvoie les positions (début, fin) de chaque objet {...} de premier niveau dans buf."""
+    # un objet par accolade ouvrante au plus
+    spans = np.empty(((buf == 123).sum(), 2), dtype=np.int64)
+    n = 0
+    depth = 0
+    start = 0
+    quote = 0
+    escape = False
+    for i in range(buf.size):
+        c = buf[i]
+        if quote != 0:
+            if escape:
+                escape = False
+            elif c == 92:  # antislash
+                escape = True
+            elif c == quote:
+                quote = 0
+        elif c == 34 or c == 39:  # " ou '
+            quote = c
+        elif c == 123:  # {
+            if depth == 0:
+                start = i
+            depth += 1
+        elif c == 125 and depth > 0:  # }
+            depth -= 1
+            if depth == 0:
+                spans[n, 0] = start
+                spans[n, 1] = i + 1
+                n += 1
+    return spans[:n]
+
+def _iter_objects(content: str):
+    """Renvoie chaque objet {...} de premier niveau en un seul parcours du texte."""
+    # Les positions sont calculées sur les octets UTF-8, on découpe donc le buffer
+    buf = content.encode()
+    for start, end in _find_objects(np.frombuffer(buf, dtype=np.uint8)):
+        yield buf[start:end].decode()
+
+def _source_objects(s: str) -> List[Dict]:
+    """Extrait les objets contenant les champs file_name, url et page d'une liste de sources."""
+    # Trouve le premier crochet ouvrant et le dernier crochet fermant
+    start = s.find('[')
+    end = s.rfind(']')
+    if start == -1 or end == -1:
+        return []
     
-    return "[]"
+    # Parcourt le contenu une seule fois pour extraire chaque objet {...}
+    objects = []
+    for obj_str in _iter_objects(s[start:end+1]):
+        try:
+            # Le LLM renvoie des dictionnaires Python (guillemets simples)
+            obj = ast.literal_eval(obj_str)
+        except (ValueError, SyntaxError):
+            try:
+                obj = orjson.loads(obj_str)
+            except orjson.JSONDecodeError:
+                continue
+        if isinstance(obj, dict) and all(key in obj for key in ['file_name', 'url', 'page']):
+            objects.append(obj)
+    return objects
 
-def extract_last_source(input_text: str) -> List[Dict[str, str]]:
-    """Extrait les informations de la dernière balise <source> dans l'input."""
-    sources = re.findall(r'<source>(.*?)</source>', input_text, re.DOTALL)
-    if not sources:
-        print("No sources found in input")
+def parse_documents(last_source: str) -> List[Dict]:
+    """Extrait directement les documents au format de sortie depuis le contenu d'une balise <source>."""
+    if not last_source:
+        logger.debug("No sources found in input")
         return []
     
     try:
-        # Nettoie et formate la chaîne pour la rendre compatible JSON
-        last_source = sources[-1].strip()
-        print("Original source length:", len(last_source))
-        
-        last_source = clean_string(last_source)
-        print("Cleaned source length:", len(last_source))
-        
-        # Si la chaîne est vide ou contient juste [], retourne une liste vide
-        if last_source == '[]' or not last_source:
-            print("Empty source found")
-            return []
-            
-        parsed_sources = json.loads(last_source)
-        print("Successfully parsed JSON, type:", type(parsed_sources))
-        
-        # Traite tous les éléments de la liste
-        if isinstance(parsed_sources, list):
-            cleaned_sources = []
-            for source in parsed_sources:
-                if isinstance(source, dict) and all(key in source for key in ['file_name', 'url', 'page']):
-                    cleaned_source = {
-                        'file_name': source.get('file_name', ''),
-                        'url': source.get('url', ''),
-                        'page': source.get('page', 0)
-                    }
-                    cleaned_sources.append(cleaned_source)
-            print(f"Found {len(cleaned_sources)} valid sources")
-            return cleaned_sources
-        return []
-    except json.JSONDecodeError as e:
-        print(f"Erreur de parsing JSON: {e}")
-        print(f"Position de l'erreur: caractère {e.pos}")
-        print(f"Ligne de l'erreur: {e.lineno}, colonne: {e.colno}")
-        print(f"Document jusqu'à l'erreur: {last_source[max(0, e.pos-50):e.pos]}<<<ERREUR ICI>>>{last_source[e.pos:e.pos+50]}")
-        return []
+        documents = [
+            {"title": obj['file_name'], "url": obj['url'], "page": obj['page']}
+            for obj in _source_objects(last_source)
+        ]
     except Exception as e:
-        print(f"Erreur inattendue: {e}")
+        logger.warning("Erreur inattendue: %s", e)
         return []
-
-def format_documents(sources: List[Dict[str, any]]) -> List[Dict]:
-    """Formate les sources en documents selon le format de sortie requis."""
-    documents = []
-    for source in sources:
-        print("Processing source:", source)  # Debug log
-        if all(key in source for key in ['file_name', 'url', 'page']):
-            doc = {
-                "title": source['file_name'],
-                "url": source['url'],
-                "page": source['page']
-            }
-            print("Adding document:", doc)  # Debug log
-            documents.append(doc)
+    logger.debug("Found %d valid sources", len(documents))
     return documents
 
 def convert_format(input_text: str) -> Dict:
     """Convertit l'input au format de sortie requis."""
-    # Extraction des données
-    text = extract_last_response(input_text)
-    sources = extract_last_source(input_text)
+    # Extraction des données en un seul parcours de l'input
+    text, last_source = _scan_last_tags(input_text)
     
     # Construction de la sortie
     output = {
         "text": text,
         "images": [],  # Liste vide comme demandé
         "experts": [], # Liste vide comme demandé
-        "documents": format_documents(sources)
+        "documents": parse_documents(last_source)
     }
     
     return output
 
+def process_input_dict(input_text: str) -> Dict:
+    """Traite l'input et retourne la sortie formatée, sérialisée une seule fois par le serveur web."""
+    return convert_format(input_text)
+
 def process_input(input_text: str) -> str:
-    """Traite l'input et retourne la sortie formatée en JSON."""
+    """Traite l'input et retourne la sortie formatée en JSON (obsolète, utiliser process_input_dict)."""
+    warnings.warn(
+        "process_input est obsolète, utiliser process_input_dict",
+        DeprecationWarning,
+        stacklevel=2
+    )
     result = convert_format(input_text)
-    return json.dumps(result, indent=4)
+    return orjson.dumps(result, option=orjson.OPT_INDENT_2).decode()
 
 if __name__ == "__main__":
     # Example input for testing
@@ -138,7 +145,7 @@ if __name__ == "__main__":
     """
     
     try:
-        output = process_input(TEST_INPUT)
-        print("Test output:", output)
+        output = process_input_dict(TEST_INPUT)
+        print("Test output:", orjson.dumps(output, option=orjson.OPT_INDENT_2).decode())
     except Exception as e:
         print(f"Error during test: {e}")
\ No newline at end of file
@@ -3,8 +3,13 @@ from llama_index.core import StorageContext, VectorStoreIndex
 from llama_index.vector_stores.supabase import SupabaseVectorStore
 from supabase import create_client
 from dotenv import load_dotenv
+from functools import lru_cache
 import os
 
+# text-embedding-3-small vectors truncated to 512 dimensions
+EMBED_MODEL = "text-embedding-3-small"
+EMBED_DIMENSIONS = 512
+
 class Indexer:
     def __init__(self):
         load_dotenv()
@@ -15,32 +20,50 @@ class Indexer:
         self.OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
         self.supabase = create_client(self.SUPABASE_URL, self.SUPABASE_KEY)
-        self.embed_model = OpenAIEmbedding(model="text-embedding-ada-002", api_key=self.OPENAI_API_KEY)
+        self.embed_model = OpenAIEmbedding(
+            model=EMBED_MODEL,
+            dimensions=EMBED_DIMENSIONS,
+            api_key=self.OPENAI_API_KEY,
+            embed_batch_size=100
+        )
         self.vector_store = SupabaseVectorStore(
             postgres_connection_string=self.SUPABASE_CONNECTION_STRING,
             collection_name="base_demo",
+            dimension=EMBED_DIMENSIONS,
         )
         
         self.storage_context = StorageContext.from_defaults(vector_store=self.vector_store)
+        self._index = None
 
     def index_document(self, documents):
         index = VectorStoreIndex.from_documents(
             documents,
             storage_context=self.storage_context, 
             embed_model=self.embed_model,
-            include_metadata=True
+            include_metadata=True,
+            insert_batch_size=512,
+            use_async=True
         )
         print("✅ Documents successfully indexed and stored in Supabase!")
+        self._index = index
         return index
     
     def retrieve_index(self):
+        # Reuse the index already loaded by this indexer
+        if self._index is not None:
+            return self._index
         # Retrieve the index from the storage context
-        index = VectorStoreIndex.from_vector_store(
+        self._index = VectorStoreIndex.from_vector_store(
             vector_store=self.vector_store,
             embed_model=self.embed_model
         )
         print("✅ Index successfully retrieved from Supabase!")
-        return index
+        return self._index
+
+@lru_cache(maxsize=1)
+def get_shared_indexer():
+    """Indexer created once per process and shared by every caller; it keeps its retrieved index."""
+    return Indexer()
 
 # Example usage:
 if __name__ == "__main__":
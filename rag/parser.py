@@ -1,39 +1,50 @@
 from llama_cloud_services import LlamaParse
 from llama_index.core import SimpleDirectoryReader
 from dotenv import load_dotenv
+from functools import lru_cache
+import asyncio
 import os
 import time
 import tempfile
 
+# Maximum number of files sent to LlamaCloud at the same time
+MAX_CONCURRENT_PARSES = 8
+
+@lru_cache(maxsize=1)
+def _initialize_parser(api_key, model_name="gemini-2.0-flash-001", result_type="markdown"):
+    """Build the LlamaParse client once and share it across Parser instances."""
+    return LlamaParse(
+        api_key=api_key,
+        use_vendor_multimodal_model=True,
+        vendor_multimodal_model_name=model_name,
+        system_prompt_append="give me an exhaustive description of every chart. Include everything: layout, text, images, graphs, etc. You also need to give me an explanation of the slide: what is the overall message that is conveyed.",
+        result_type=result_type,
+        
+    )
+
 class Parser:
     def __init__(self):
         load_dotenv()
         self.llama_cloud_api_key = os.getenv("LLAMA_CLOUD_API_KEY")
-        self.parser = self._initialize_parser()
-        
-    def _initialize_parser(self):
-        return LlamaParse(
-            api_key=self.llama_cloud_api_key,
-            use_vendor_multimodal_model=True,
-            vendor_multimodal_model_name="gemini-2.0-flash-001",
-            system_prompt_append="give me an exhaustive description of every chart. Include everything: layout, text, images, graphs, etc. You also need to give me an explanation of the slide: what is the overall message that is conveyed.",
-            result_type="markdown",
-            
-        )
+        self.parser = _initialize_parser(self.llama_cloud_api_key)
     
-    def parse_document(self, file_path):
-        file_extractor = {os.path.splitext(file_path)[1]: self.parser}
+    def parse_document(self, file_path, file_extractor=None):
+        if file_extractor is None:
+            file_extractor = {os.path.splitext(file_path)[1]: self.parser}
         chunks = SimpleDirectoryReader(
             input_files=[file_path],
             file_extractor=file_extractor
         ).load_data()
         
+        return self._set_page_numbers(chunks, file_path)
+
+    def _set_page_numbers(self, chunks, file_path):
         # Extraire et incrémenter le numéro de page à partir du doc_id
         for chunk in chunks:
-            try:
-                page_str = chunk.doc_id.split('_')[-1]
+            page_str = chunk.doc_id.rpartition('_')[2]
+            if page_str.isdigit():
                 chunk.metadata['page_number'] = int(page_str) + 1
-            except (ValueError, IndexError):
+            else:
                 print(f"Warning: Could not extract page number from doc_id: {chunk.doc_id}")
                 chunk.metadata['page_number'] = 0
         
@@ -50,12 +61,17 @@ class Parser:
 
     def parse_directory(self, directory):
         file_paths = self.list_all_files(directory)
-        documents = []
         
         start_time = time.time()  # Start timer
         
-        for file_path in file_paths:
-            documents += self.parse_document(file_path)
+        # A single reader for every file; it awaits LlamaParse with bounded concurrency
+        reader = SimpleDirectoryReader(
+            input_files=file_paths,
+            filename_as_id=True,
+            file_extractor={os.path.splitext(file_path)[1]: self.parser for file_path in file_paths}
+        )
+        documents = asyncio.run(reader.aload_data(num_workers=MAX_CONCURRENT_PARSES))
+        documents = self._set_page_numbers(documents, directory)
         
         end_time = time.time()  # End timer
         elapsed_time = end_time - start_time
@@ -101,12 +117,12 @@ class Parser:
             
             # Extract and increment page number from doc_id
             for chunk in chunks:
-                try:
-                    page_str = chunk.doc_id.split('_')[-1]
-                    chunk.metadata = cloud_metadata
-                    
+                page_str = chunk.doc_id.rpartition('_')[2]
+                # Each chunk gets its own copy so page numbers don't overwrite each other
+                chunk.metadata = dict(cloud_metadata)
+                if page_str.isdigit():
                     chunk.metadata['page_number'] = int(page_str) + 1
-                except (ValueError, IndexError):
+                else:
                     print(f"Warning: Could not extract page number from doc_id: {chunk.doc_id}")
                     chunk.metadata['page_number'] = 0
             
@@ -1,67 +1,35 @@
-from router import RouterQueryWorkflow
-from indexer import Indexer
+from router import RouterQueryWorkflow, ResponseDeltaEvent
+from indexer import get_shared_indexer
 from agent import RouterOutputAgentWorkflow
+from cache import SemanticCache
 
 from llama_index.llms.gemini import Gemini
 from llama_index.core import PromptTemplate
 from llama_index.core.query_engine import RetrieverQueryEngine
 
 
+import asyncio
 import uvicorn
-from fastapi import FastAPI, HTTPException
+from contextlib import asynccontextmanager
+import orjson
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from convert import process_input
+from convert import process_input_dict
 from fastapi.middleware.cors import CORSMiddleware
-from IPython.display import display, Markdown
+from starlette.middleware.cors import ALL_METHODS, SAFELISTED_HEADERS
 from dotenv import load_dotenv
+import os
+import logging
 load_dotenv()
 
+logger = logging.getLogger(__name__)
 
+# build_agent retries: exponential backoff from 1 s, capped
+INIT_MAX_ATTEMPTS = 5
+INIT_MAX_BACKOFF = 60
 
-indexer = Indexer()
-index = indexer.retrieve_index()
 
-llm = Gemini(model = "models/gemini-2.0-flash")
-
-doc_retriever = index.as_retriever(
-    retrieval_mode="files_via_content", 
-    files_top_k=1,
-    include_metadata=True
-)
-query_engine_doc = RetrieverQueryEngine.from_args(
-    doc_retriever, 
-    llm=llm, 
-    response_mode="tree_summarize",
-    response_synthesizer_kwargs={
-        "text_template": (
-            "Document complet (pages {metadata[page_number]}):\n"
-            "```\n"
-            "{text}\n"
-            "```\n\n"
-        ),
-        "include_metadata": True
-    }
-)
-
-chunk_retriever = index.as_retriever(
-    retrieval_mode="chunks", 
-    rerank_top_n=10,
-    include_metadata=True
-)
-query_engine_chunk = RetrieverQueryEngine.from_args(
-    chunk_retriever, 
-    llm=llm, 
-    response_mode="tree_summarize",
-    response_synthesizer_kwargs={
-        "text_template": (
-            "Page {metadata[page_number]}:\n"
-            "```\n"
-            "{text}\n"
-            "```\n\n"
-        ),
-        "include_metadata": True
-    }
-)
 
 # tells LLM to select choices given a list
 ROUTER_PROMPT = PromptTemplate(
@@ -95,52 +63,294 @@ Below we give details on the format of each document:
 {DOC_METADATA_EXTRA_STR}
 """
 
-router_query_workflow = RouterQueryWorkflow(
-    query_engines=[query_engine_doc, query_engine_chunk],
-    choice_descriptions=[TOOL_DOC_DESC, TOOL_CHUNK_DESC],
-    verbose=True,
-    llm=llm,
-    router_prompt=ROUTER_PROMPT,
-    timeout=60
+# Node formatting templates for the doc and chunk synthesizers
+DOC_TEXT_TEMPLATE = (
+    "Document complet (pages {metadata[page_number]}):\n"
+    "```\n"
+    "{text}\n"
+    "```\n\n"
+)
+
+CHUNK_TEXT_TEMPLATE = (
+    "Page {metadata[page_number]}:\n"
+    "```\n"
+    "{text}\n"
+    "```\n\n"
 )
 
-agent = RouterOutputAgentWorkflow(router_query_workflow, verbose=True, timeout=60)
+def build_query_engine(retriever, llm, text_template):
+    """Tree-summarize query engine; leaf summaries run concurrently, the final answer streams."""
+    return RetrieverQueryEngine.from_args(
+        retriever, 
+        llm=llm, 
+        response_mode="tree_summarize",
+        use_async=True,
+        streaming=True,
+        response_synthesizer_kwargs={
+            "text_template": text_template,
+            "include_metadata": True
+        }
+    )
+
+def build_agent():
+    """Builds the index, query engines and agent; slow, involves network calls."""
+    indexer = get_shared_indexer()
+    index = indexer.retrieve_index()
+
+    # one client for the router, both query engines and the summarizer
+    llm = Gemini(model = "models/gemini-2.0-flash")
 
-async def process_query(message):
-    response = await agent.run(message=message)
-    display(Markdown(response))
+    doc_retriever = index.as_retriever(
+        retrieval_mode="files_via_content", 
+        files_top_k=1,
+        include_metadata=True
+    )
+    query_engine_doc = build_query_engine(doc_retriever, llm, DOC_TEXT_TEMPLATE)
+
+    chunk_retriever = index.as_retriever(
+        retrieval_mode="chunks", 
+        rerank_top_n=10,
+        include_metadata=True
+    )
+    query_engine_chunk = build_query_engine(chunk_retriever, llm, CHUNK_TEXT_TEMPLATE)
+
+    # workflow validation only when explicitly requested for development
+    disable_validation = os.getenv("WORKFLOW_VALIDATE") != "1"
+
+    router_query_workflow = RouterQueryWorkflow(
+        query_engines=[query_engine_doc, query_engine_chunk],
+        choice_descriptions=[TOOL_DOC_DESC, TOOL_CHUNK_DESC],
+        verbose=True,
+        llm=llm,
+        router_prompt=ROUTER_PROMPT,
+        timeout=60,
+        disable_validation=disable_validation,
+        speculative_retrieval=os.getenv("ROUTER_SPECULATIVE_RETRIEVAL") == "1",
+        router_batching=os.getenv("ROUTER_BATCHING") == "1"
+    )
+
+    agent = RouterOutputAgentWorkflow(
+        router_query_workflow,
+        verbose=True,
+        timeout=60,
+        disable_validation=disable_validation
+    )
+    return indexer, router_query_workflow, agent
+
+async def process_query(agent, message, no_cache=False):
+    response = await agent.run(message=message, no_cache=no_cache)
+    if os.getenv("DEBUG_DISPLAY"):
+        # notebook rendering for development only
+        from IPython.display import display, Markdown
+        display(Markdown(response))
     return response
 
 async def convert(response):
-    return process_input(response)
+    # Parsing large <source> blocks runs in a worker thread to keep the event loop free
+    return await asyncio.to_thread(process_input_dict, response)
 
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Build the agent in the background so the server starts answering (503) right away
+    app.state.indexer = None
+    app.state.rag_workflow = None
+    app.state.agent = None
+    # set once every build_agent attempt failed; requests then get a 500 instead of a 503
+    app.state.init_error = None
+    # Serves paraphrased repeats of earlier questions without running the workflow
+    app.state.semantic_cache = SemanticCache(quantize=os.getenv("SEMANTIC_CACHE_INT8") == "1")
 
-app.add_middleware(
-    CORSMiddleware,
+    async def initialize():
+        delay = 1
+        for attempt in range(1, INIT_MAX_ATTEMPTS + 1):
+            try:
+                app.state.indexer, app.state.rag_workflow, app.state.agent = await asyncio.to_thread(build_agent)
+                return
+            except Exception as e:
+                logger.exception("Agent initialization failed (attempt %d/%d)", attempt, INIT_MAX_ATTEMPTS)
+                if attempt == INIT_MAX_ATTEMPTS:
+                    app.state.init_error = e
+                    return
+            await asyncio.sleep(delay)
+            delay = min(2 * delay, INIT_MAX_BACKOFF)
+
+    init_task = asyncio.create_task(initialize())
+    yield
+    init_task.cancel()
+
+
+# Single source for CORSMiddleware and the preflight shortcut in front of it
+CORS_SETTINGS = dict(
     allow_origins=["*"],  # Allows all origins
     allow_credentials=True,
     allow_methods=["*"],  # Allows all methods
-    allow_headers=["*"]  # Allows all headers
+    allow_headers=["*"],  # Allows all headers
+    max_age=600,
 )
 
+class PreflightMiddleware:
+    """Answers valid CORS preflight requests before the rest of the middleware stack.
+
+    Takes the CORSMiddleware settings and sends the same headers; disallowed
+    preflights fall through to CORSMiddleware, which rejects them.
+    """
+
+    def __init__(self, app, allow_origins=(), allow_credentials=False, allow_methods=("GET",),
+                 allow_headers=(), max_age=600):
+        self.app = app
+        self.allow_all_origins = "*" in allow_origins
+        self.allow_origins = {origin.encode() for origin in allow_origins}
+        self.allow_all_headers = "*" in allow_headers
+        self.allow_headers = {header.lower() for header in SAFELISTED_HEADERS | set(allow_headers)}
+        methods = ALL_METHODS if "*" in allow_methods else allow_methods
+        self.allow_methods = {method.encode() for method in methods}
+        # With credentials, or a list of origins, the origin must be echoed rather than "*"
+        self.echo_origin = not self.allow_all_origins or allow_credentials
+
+        self.headers = [
+            (b"access-control-allow-methods", ", ".join(methods).encode()),
+            (b"access-control-max-age", str(max_age).encode()),
+        ]
+        if allow_credentials:
+            self.headers.append((b"access-control-allow-credentials", b"true"))
+        if not self.allow_all_headers:
+            self.headers.append((b"access-control-allow-headers", ", ".join(sorted(self.allow_headers)).encode()))
+        if self.echo_origin:
+            self.headers.append((b"vary", b"Origin"))
+
+    def _allowed(self, origin, method, requested_headers) -> bool:
+        if not self.allow_all_origins and origin not in self.allow_origins:
+            return False
+        if method not in self.allow_methods:
+            return False
+        if requested_headers is None or self.allow_all_headers:
+            return True
+        return all(h.strip() in self.allow_headers for h in requested_headers.decode().lower().split(","))
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] == "OPTIONS":
+            request_headers = dict(scope["headers"])
+            origin = request_headers.get(b"origin")
+            method = request_headers.get(b"access-control-request-method")
+            requested_headers = request_headers.get(b"access-control-request-headers")
+            if origin is not None and method is not None and self._allowed(origin, method, requested_headers):
+                headers = self.headers + [(b"access-control-allow-origin", origin if self.echo_origin else b"*")]
+                if self.allow_all_headers and requested_headers is not None:
+                    headers.append((b"access-control-allow-headers", requested_headers))
+                await send({"type": "http.response.start", "status": 204, "headers": headers})
+                await send({"type": "http.response.body", "body": b""})
+                return
+        await self.app(scope, receive, send)
+
+
+app = FastAPI(lifespan=lifespan)
+
+app.add_middleware(CORSMiddleware, **CORS_SETTINGS)
+# Added last so it wraps CORSMiddleware and sees preflights first
+app.add_middleware(PreflightMiddleware, **CORS_SETTINGS)
+
 class Query(BaseModel):
     message: str
+    workspace: str = "default"
+    no_cache: bool = False
+
+
+def require_ready(request: Request, service):
+    """Returns the service, or raises 500 if startup failed and 503 while it is in progress."""
+    if service is None:
+        init_error = request.app.state.init_error
+        if init_error is not None:
+            raise HTTPException(status_code=500, detail=f"Service failed to start: {init_error}")
+        raise HTTPException(status_code=503, detail="Service is starting, please retry shortly.")
+    return service
+
+async def cache_lookup(query: Query, request: Request):
+    """Returns the query embedding and the cached response, (None, None) when caching is off.
 
+    Cache errors are logged and treated as a miss: the query still runs.
+    """
+    if query.no_cache:
+        return None, None
+    try:
+        query_embedding = await request.app.state.indexer.embed_model.aget_query_embedding(query.message)
+    except Exception:
+        logger.exception("Semantic cache: embedding the query failed, skipping the cache")
+        return None, None
+    try:
+        response = request.app.state.semantic_cache.lookup(query_embedding, namespace=query.workspace)
+    except Exception:
+        logger.exception("Semantic cache lookup failed, treating it as a miss")
+        response = None
+    return query_embedding, response
+
+async def cache_insert(query: Query, request: Request, query_embedding, response):
+    """Stores the response under the query's workspace, unless caching is off.
+
+    A failed write is logged and skipped, so the computed answer is still returned.
+    """
+    if query_embedding is None:
+        return
+    try:
+        await request.app.state.semantic_cache.ainsert(query_embedding, response, namespace=query.workspace)
+    except Exception:
+        logger.exception("Semantic cache insert failed, response not cached")
 
 @app.post("/query")
-async def query_endpoint(query: Query):
+async def query_endpoint(query: Query, request: Request):
+    agent = require_ready(request, request.app.state.agent)
     try:
-        # Correctly pass the message string and await directly
-        response = await process_query(query.message)
+        query_embedding, response = await cache_lookup(query, request)
+        if response is None:
+            # Correctly pass the message string and await directly
+            response = await process_query(agent, query.message, no_cache=query.no_cache)
+            await cache_insert(query, request, query_embedding, response)
         response = await convert(response)
         return {"response": response}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
 
+def sse_event(data, event=None):
+    """Formats a Server-Sent Event frame with a JSON payload."""
+    frame = f"event: {event}\n" if event else ""
+    return frame + f"data: {orjson.dumps(data).decode()}\n\n"
+
+@app.post("/query/stream")
+async def query_stream_endpoint(query: Query, request: Request):
+    # The agent's extra text is dropped by convert anyway: stream the RAG workflow directly
+    rag_workflow = require_ready(request, request.app.state.rag_workflow)
+
+    async def event_stream():
+        try:
+            query_embedding, cached = await cache_lookup(query, request)
+            if cached is not None:
+                response = await convert(cached)
+                yield sse_event({"delta": response["text"]})
+            else:
+                handler = rag_workflow.run(query_str=query.message, no_cache=query.no_cache)
+                async for ev in handler.stream_events():
+                    if isinstance(ev, ResponseDeltaEvent):
+                        yield sse_event({"delta": ev.delta})
+                result = await handler
+                await cache_insert(query, request, query_embedding, result)
+                response = await convert(result)
+            # sources only known at the end of the stream
+            yield sse_event(response["documents"], event="sources")
+        except Exception as e:
+            yield sse_event({"detail": str(e)}, event="error")
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
 if __name__ == "__main__":
-    uvicorn.run("processor:app", host="localhost", port=8000, reload=True)
+    # uvloop event loop when installed; auto-reload only when explicitly requested for development
+    uvicorn.run(
+        "processor:app",
+        host="localhost",
+        port=8000,
+        loop="auto",
+        reload=os.getenv("RELOAD") == "1"
+    )
 
 
@@ -1,13 +1,17 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
 from typing import List, Optional, Any
 from llama_index.core.bridge.pydantic import BaseModel
 from llama_index.core.query_engine import (
     BaseQueryEngine
 )
 from llama_index.core import PromptTemplate
-from llama_index.llms.gemini import Gemini
 from llama_index.core.llms import LLM
 from llama_index.core.response_synthesizers import TreeSummarize
 from llama_index.core.workflow import (
+    Context,
     Workflow,
     Event,
     StartEvent,
@@ -16,6 +20,12 @@ from llama_index.core.workflow import (
 )
 import os, json
 
+logger = logging.getLogger(__name__)
+
+# Exact-match cache of query engine responses, keyed by (engine index, query)
+QUERY_CACHE_MAX_SIZE = 512
+QUERY_CACHE_TTL = 3600
+
 class Answer(BaseModel):
     """Answer model."""
 
@@ -32,6 +42,8 @@ class ChooseQueryEngineEvent(Event):
 
     answers: Answers
     query_str: str
+    # skip the exact-match cache of engine responses
+    no_cache: bool = False
 
 class SynthesizeAnswersEvent(Event):
     """Synthesize answers event."""
@@ -52,6 +64,7 @@ class RouterQueryWorkflow(Workflow):
         verbose: bool = False,
         llm: Optional[LLM] = None,
         summarizer: Optional[TreeSummarize] = None,
+        speculative_retrieval: bool = False,
     ):
         """Constructor"""
 
@@ -77,8 +90,21 @@ class RouterQueryWorkflow(Workflow):
         # Use provided values or defaults
         self.router_prompt = router_prompt or self._default_router_prompt
         self.choice_descriptions = choice_descriptions or [self._default_tool_doc_desc, self._default_tool_chunk_desc]
-        self.llm = llm or Gemini(temperature=0, model="gemini-2.0-flash-001")
-        self.summarizer = summarizer or TreeSummarize()
+        if llm is None:
+            # the caller owns the single client shared with the query engines
+            raise ValueError("llm must be provided and shared with the query engines")
+        self.llm = llm
+        self.summarizer = summarizer or TreeSummarize(llm=self.llm)
+
+        # choices never change after construction: format the router inputs once
+        self._router_prompt_partial: PromptTemplate = self.router_prompt.partial_format(
+            num_choices=len(self.choice_descriptions),
+            max_outputs=len(self.choice_descriptions),
+        )
+        self._choices_str: str = self._get_choice_str(self.choice_descriptions)
+        # query every engine while the router decides; doubles retriever cost
+        self.speculative_retrieval = speculative_retrieval
+        self._query_cache = OrderedDict()
 
 
     def _load_configs(self):
@@ -93,60 +119,113 @@ class RouterQueryWorkflow(Workflow):
         choices_str = "\n\n".join([f"{idx+1}. {c}" for idx, c in enumerate(choices)])
         return choices_str
 
-    async def _query(self, query_str: str, choice_idx: int):
+    def clear_query_cache(self):
+        """Drops every cached engine response, e.g. after re-indexing."""
+
+        self._query_cache.clear()
+
+    async def _query(self, query_str: str, choice_idx: int, no_cache: bool = False):
         """Query using query engine"""
 
+        # exact-match cache: identical queries skip embedding, vector search and rerank
+        key = (choice_idx, query_str)
+        now = time.monotonic()
+        cached = None if no_cache else self._query_cache.get(key)
+        if cached is not None and now - cached[0] < QUERY_CACHE_TTL:
+            self._query_cache.move_to_end(key)
+            return cached[1]
+
         query_engine = self.query_engines[choice_idx]
         response = await query_engine.aquery(query_str)
+
+        self._query_cache[key] = (now, response)
+        self._query_cache.move_to_end(key)
+        if len(self._query_cache) > QUERY_CACHE_MAX_SIZE:
+            self._query_cache.popitem(last=False)
         return response
 
 
-    @step()
-    async def choose_query_engine(self, ev: StartEvent) -> ChooseQueryEngineEvent:
+    @step(pass_context=True)
+    async def choose_query_engine(self, ctx: Context, ev: StartEvent) -> ChooseQueryEngineEvent:
         """Choose query engine."""
 
         # get query str
         query_str = ev.get("query_str")
         if query_str is None:
             raise ValueError("'query_str' is required.")
+        no_cache = ev.get("no_cache", False)
 
-        # partially format prompt with number of choices and max outputs
-        router_prompt1 = self.router_prompt.partial_format(
-            num_choices=len(self.choice_descriptions),
-            max_outputs=len(self.choice_descriptions),
-        )
+        # speculatively query every engine while the LLM picks the relevant ones
+        speculative_queries = []
+        if self.speculative_retrieval:
+            speculative_queries = [
+                asyncio.create_task(self._query(query_str, idx, no_cache=no_cache))
+                for idx in range(len(self.query_engines))
+            ]
+        await ctx.set("speculative_queries", speculative_queries)
 
         # get choices selected by LLM
-        choices_str = self._get_choice_str(self.choice_descriptions)
-        output = self.llm.structured_predict(
-            Answers,
-            router_prompt1,
-            context_list=choices_str,
-            query_str=query_str
-        )
+        try:
+            output = await self.llm.astructured_predict(
+                Answers,
+                self._router_prompt_partial,
+                context_list=self._choices_str,
+                query_str=query_str
+            )
+        except BaseException:
+            for task in speculative_queries:
+                task.cancel()
+            raise
 
         if self._verbose:
             print(f"Selected choice(s):")
             for answer in output.answers:
                 print(f"Choice: {answer.choice}, Reason: {answer.reason}")
 
-        return ChooseQueryEngineEvent(answers=output, query_str=query_str)
+        return ChooseQueryEngineEvent(answers=output, query_str=query_str, no_cache=no_cache)
 
-    @step()
-    async def query_each_engine(self, ev: ChooseQueryEngineEvent) -> SynthesizeAnswersEvent:
+    @step(pass_context=True)
+    async def query_each_engine(self, ctx: Context, ev: ChooseQueryEngineEvent) -> SynthesizeAnswersEvent:
         """Query each engine."""
 
         query_str = ev.query_str
         answers = ev.answers
 
-        # query using corresponding query engine given in Answers list
+        # query the engines selected in Answers list concurrently
+        speculative_queries = await ctx.get("speculative_queries", default=[])
+        try:
+            if speculative_queries:
+                # reuse the speculative queries of the selected engines, drop the others
+                selected = {answer.choice - 1 for answer in answers.answers}
+                for idx, task in enumerate(speculative_queries):
+                    if idx not in selected:
+                        task.cancel()
+                tasks = [speculative_queries[answer.choice - 1] for answer in answers.answers]
+            else:
+                tasks = [
+                    self._query(query_str, answer.choice - 1, no_cache=ev.no_cache)
+                    for answer in answers.answers
+                ]
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            # an out-of-range choice or a cancellation must not leave speculative queries unawaited
+            for task in speculative_queries:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    # mark errors of unselected engines as retrieved
+                    task.exception()
         responses = []
+        for answer, result in zip(answers.answers, results):
+            if isinstance(result, BaseException):
+                # the answer is synthesized from the remaining engines
+                logger.warning("Query engine %d failed", answer.choice, exc_info=result)
+            else:
+                responses.append(result)
+        if not responses and results:
+            # every engine failed: surface the first error
+            raise results[0]
 
-        for answer in answers.answers:
-            choice_idx = answer.choice - 1
-            response = await self._query(query_str, choice_idx)
-            responses.append(response)
-        
         return SynthesizeAnswersEvent(responses=responses, query_str=query_str)
 
     @step()
@@ -157,7 +236,7 @@ class RouterQueryWorkflow(Workflow):
 
         
         response_strs = [str(r) for r in responses]
-        text = self.summarizer.get_response(
+        text = await self.summarizer.aget_response(
             query_str, 
             response_strs,
             include_metadata=True
@@ -1,13 +1,19 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+import orjson
 from typing import List, Optional, Any
 from llama_index.core.bridge.pydantic import BaseModel
 from llama_index.core.query_engine import (
     BaseQueryEngine
 )
 from llama_index.core import PromptTemplate
-from llama_index.llms.gemini import Gemini
 from llama_index.core.llms import LLM
 from llama_index.core.response_synthesizers import TreeSummarize
+from llama_index.core.base.response.schema import Response
 from llama_index.core.workflow import (
+    Context,
     Workflow,
     Event,
     StartEvent,
@@ -15,6 +21,12 @@ from llama_index.core.workflow import (
     step,
 )
 
+logger = logging.getLogger(__name__)
+
+# Exact-match cache of query engine responses, keyed by (engine index, query)
+QUERY_CACHE_MAX_SIZE = 512
+QUERY_CACHE_TTL = 3600
+
 class Answer(BaseModel):
     """Answer model."""
 
@@ -26,17 +38,137 @@ class Answers(BaseModel):
 
     answers: List[Answer]
 
+class BatchAnswers(BaseModel):
+    """Answers for a batch of questions, in the order the questions were given."""
+
+    batch: List[Answers]
+
+# tells LLM to select choices for several questions at once
+ROUTER_BATCH_PROMPT = PromptTemplate(
+    "Some choices are given below. It is provided in a numbered list (1 to"
+    " {num_choices}), where each item in the list corresponds to a"
+    " summary.\n---------------------\n{context_list}\n---------------------\n"
+    "Several questions are given below in a numbered list.\n---------------------\n"
+    "{query_list}\n---------------------\nFor each question, in the same order, using"
+    " only the choices above and not prior knowledge, return the top choices"
+    " (no more than {max_outputs}, but only select what is needed) that are"
+    " most relevant to the question. Return exactly {num_queries} entries.\n"
+)
+
+class RouterBatcher:
+    """Groups concurrent router calls into a single structured LLM call."""
+
+    def __init__(
+        self,
+        llm: LLM,
+        router_prompt: PromptTemplate,
+        batch_prompt: PromptTemplate = ROUTER_BATCH_PROMPT,
+        max_batch: int = 16,
+        max_wait: float = 0.03,
+    ):
+        self.llm = llm
+        self.router_prompt = router_prompt
+        self.batch_prompt = batch_prompt
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue: Optional[asyncio.Queue] = None
+        self._consumer: Optional[asyncio.Task] = None
+        # the loop only keeps weak references to tasks
+        self._tasks: set = set()
+
+    async def predict(self, context_list: str, num_choices: int, query_str: str) -> Answers:
+        """Queues a question and waits for the answers of the batch it ends up in."""
+
+        if self._consumer is None or self._consumer.done():
+            self._queue = asyncio.Queue()
+            self._consumer = asyncio.create_task(self._consume())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((context_list, num_choices, query_str, future))
+        return await future
+
+    async def _consume(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # questions with different choices cannot share a prompt
+            groups = {}
+            for item in batch:
+                groups.setdefault((item[0], item[1]), []).append(item)
+            for (context_list, num_choices), items in groups.items():
+                task = asyncio.create_task(self._resolve(context_list, num_choices, items))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    async def _resolve(self, context_list: str, num_choices: int, items):
+        futures = [item[3] for item in items]
+        try:
+            if len(items) == 1:
+                results = [await self.llm.astructured_predict(
+                    Answers,
+                    self.router_prompt,
+                    num_choices=num_choices,
+                    max_outputs=num_choices,
+                    context_list=context_list,
+                    query_str=items[0][2]
+                )]
+            else:
+                query_list = "\n".join(f"{idx+1}. {item[2]}" for idx, item in enumerate(items))
+                output = await self.llm.astructured_predict(
+                    BatchAnswers,
+                    self.batch_prompt,
+                    num_choices=num_choices,
+                    max_outputs=num_choices,
+                    num_queries=len(items),
+                    context_list=context_list,
+                    query_list=query_list
+                )
+                results = output.batch
+                if len(results) != len(items):
+                    raise ValueError(f"Router returned {len(results)} answers for {len(items)} questions")
+        except BaseException as e:
+            # also on cancellation, so that no caller waits until the workflow timeout
+            for future in futures:
+                if not future.done():
+                    if isinstance(e, asyncio.CancelledError):
+                        future.cancel()
+                    else:
+                        future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+            return
+        for future, result in zip(futures, results):
+            if not future.done():
+                future.set_result(result)
+
 class ChooseQueryEngineEvent(Event):
     """Query engine event."""
 
     answers: Answers
     query_str: str
+    # skip the exact-match cache of engine responses
+    no_cache: bool = False
+
+class ResponseDeltaEvent(Event):
+    """Streamed piece of the synthesized answer text."""
+
+    delta: str
 
 class SynthesizeAnswersEvent(Event):
     """Synthesize answers event."""
 
     responses: List[Any]
     query_str: str
+    # the single response was already forwarded as ResponseDeltaEvents
+    streamed: bool = False
 
 class RouterQueryWorkflow(Workflow):
     """Router query workflow."""
@@ -51,6 +183,8 @@ class RouterQueryWorkflow(Workflow):
         verbose: bool = False,
         llm: Optional[LLM] = None,
         summarizer: Optional[TreeSummarize] = None,
+        speculative_retrieval: bool = False,
+        router_batching: bool = False,
     ):
         """Constructor"""
 
@@ -59,8 +193,25 @@ class RouterQueryWorkflow(Workflow):
         self.query_engines: List[BaseQueryEngine] = query_engines
         self.choice_descriptions: List[str] = choice_descriptions
         self.router_prompt: PromptTemplate = router_prompt
-        self.llm: LLM = llm or Gemini(temperature=0, model="gemini-2.0-flash-001")
-        self.summarizer: TreeSummarize = summarizer or TreeSummarize()
+        if llm is None:
+            # the caller owns the single client shared with the query engines
+            raise ValueError("llm must be provided and shared with the query engines")
+        self.llm: LLM = llm
+        self.summarizer: TreeSummarize = summarizer or TreeSummarize(llm=self.llm, streaming=True)
+
+        # choices never change after construction: format the router inputs once
+        self._router_prompt_partial: PromptTemplate = self.router_prompt.partial_format(
+            num_choices=len(self.choice_descriptions),
+            max_outputs=len(self.choice_descriptions),
+        )
+        self._choices_str: str = self._get_choice_str(self.choice_descriptions)
+        # query every engine while the router decides; doubles retriever cost
+        self.speculative_retrieval: bool = speculative_retrieval
+        self._query_cache: OrderedDict = OrderedDict()
+        # group router calls of concurrent requests into one LLM call
+        self.router_batcher: Optional[RouterBatcher] = (
+            RouterBatcher(self.llm, self.router_prompt) if router_batching else None
+        )
 
     def _get_choice_str(self, choices):
         """String of choices to feed into LLM."""
@@ -68,100 +219,207 @@ class RouterQueryWorkflow(Workflow):
         choices_str = "\n\n".join([f"{idx+1}. {c}" for idx, c in enumerate(choices)])
         return choices_str
 
-    async def _query(self, query_str: str, choice_idx: int):
+    @staticmethod
+    def _response_text(response) -> str:
+        """Answer text of a query engine response, read directly from its attribute."""
+
+        return getattr(response, 'response', None) or str(response)
+
+    @staticmethod
+    async def _collect(response, ctx: Optional[Context] = None):
+        """Turns a streaming query engine response into a plain Response, forwarding tokens to ctx."""
+
+        if not hasattr(response, 'async_response_gen'):
+            return response
+        deltas = []
+        async for delta in response.async_response_gen():
+            deltas.append(delta)
+            if ctx is not None:
+                ctx.write_event_to_stream(ResponseDeltaEvent(delta=delta))
+        return Response(
+            response="".join(deltas),
+            source_nodes=response.source_nodes,
+            metadata=response.metadata
+        )
+
+    def clear_query_cache(self):
+        """Drops every cached engine response, e.g. after re-indexing."""
+
+        self._query_cache.clear()
+
+    async def _query(
+        self, query_str: str, choice_idx: int, ctx: Optional[Context] = None, no_cache: bool = False
+    ):
         """Query using query engine"""
 
+        # exact-match cache: identical queries skip embedding, vector search and rerank
+        key = (choice_idx, query_str)
+        now = time.monotonic()
+        cached = None if no_cache else self._query_cache.get(key)
+        if cached is not None and now - cached[0] < QUERY_CACHE_TTL:
+            self._query_cache.move_to_end(key)
+            if ctx is not None:
+                ctx.write_event_to_stream(ResponseDeltaEvent(delta=self._response_text(cached[1])))
+            return cached[1]
+
         query_engine = self.query_engines[choice_idx]
-        response = await query_engine.aquery(query_str)
+        # streaming engines: tokens reach ctx's event stream as soon as they are decoded
+        response = await self._collect(await query_engine.aquery(query_str), ctx)
+
+        self._query_cache[key] = (now, response)
+        self._query_cache.move_to_end(key)
+        if len(self._query_cache) > QUERY_CACHE_MAX_SIZE:
+            self._query_cache.popitem(last=False)
         return response
 
 
-    @step()
-    async def choose_query_engine(self, ev: StartEvent) -> ChooseQueryEngineEvent:
+    @step(pass_context=True)
+    async def choose_query_engine(self, ctx: Context, ev: StartEvent) -> ChooseQueryEngineEvent:
         """Choose query engine."""
 
         # get query str
         query_str = ev.get("query_str")
         if query_str is None:
             raise ValueError("'query_str' is required.")
+        no_cache = ev.get("no_cache", False)
 
-        # partially format prompt with number of choices and max outputs
-        router_prompt1 = self.router_prompt.partial_format(
-            num_choices=len(self.choice_descriptions),
-            max_outputs=len(self.choice_descriptions),
-        )
+        # speculatively query every engine while the LLM picks the relevant ones
+        speculative_queries = []
+        if self.speculative_retrieval:
+            speculative_queries = [
+                asyncio.create_task(self._query(query_str, idx, no_cache=no_cache))
+                for idx in range(len(self.query_engines))
+            ]
+        await ctx.set("speculative_queries", speculative_queries)
 
         # get choices selected by LLM
-        choices_str = self._get_choice_str(self.choice_descriptions)
-        output = self.llm.structured_predict(
-            Answers,
-            router_prompt1,
-            context_list=choices_str,
-            query_str=query_str
-        )
+        try:
+            if self.router_batcher is not None:
+                output = await self.router_batcher.predict(
+                    self._choices_str,
+                    len(self.choice_descriptions),
+                    query_str
+                )
+            else:
+                output = await self.llm.astructured_predict(
+                    Answers,
+                    self._router_prompt_partial,
+                    context_list=self._choices_str,
+                    query_str=query_str
+                )
+        except BaseException:
+            for task in speculative_queries:
+                task.cancel()
+            raise
 
         if self._verbose:
             print(f"Selected choice(s):")
             for answer in output.answers:
                 print(f"Choice: {answer.choice}, Reason: {answer.reason}")
 
-        return ChooseQueryEngineEvent(answers=output, query_str=query_str)
+        return ChooseQueryEngineEvent(answers=output, query_str=query_str, no_cache=no_cache)
 
-    @step()
-    async def query_each_engine(self, ev: ChooseQueryEngineEvent) -> SynthesizeAnswersEvent:
+    @step(pass_context=True)
+    async def query_each_engine(self, ctx: Context, ev: ChooseQueryEngineEvent) -> SynthesizeAnswersEvent:
         """Query each engine."""
 
         query_str = ev.query_str
         answers = ev.answers
-
-        # query using corresponding query engine given in Answers list
+        streamed = False
+
+        # query the engines selected in Answers list concurrently
+        speculative_queries = await ctx.get("speculative_queries", default=[])
+        try:
+            if speculative_queries:
+                # reuse the speculative queries of the selected engines, drop the others
+                selected = {answer.choice - 1 for answer in answers.answers}
+                for idx, task in enumerate(speculative_queries):
+                    if idx not in selected:
+                        task.cancel()
+                tasks = [speculative_queries[answer.choice - 1] for answer in answers.answers]
+            elif len(answers.answers) == 1:
+                # a single answer needs no summarization: stream it straight from the engine
+                tasks = [self._query(query_str, answers.answers[0].choice - 1, ctx, no_cache=ev.no_cache)]
+                streamed = True
+            else:
+                tasks = [
+                    self._query(query_str, answer.choice - 1, no_cache=ev.no_cache)
+                    for answer in answers.answers
+                ]
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            # an out-of-range choice or a cancellation must not leave speculative queries unawaited
+            for task in speculative_queries:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    # mark errors of unselected engines as retrieved
+                    task.exception()
         responses = []
-
-        for answer in answers.answers:
-            choice_idx = answer.choice - 1
-            response = await self._query(query_str, choice_idx)
-            responses.append(response)
-        return SynthesizeAnswersEvent(responses=responses, query_str=query_str)
-
-    @step()
-    async def synthesize_response(self, ev: SynthesizeAnswersEvent) -> StopEvent:
+        for answer, result in zip(answers.answers, results):
+            if isinstance(result, BaseException):
+                # the answer is synthesized from the remaining engines
+                logger.warning("Query engine %d failed", answer.choice, exc_info=result)
+            else:
+                responses.append(result)
+        if not responses and results:
+            # every engine failed: surface the first error
+            raise results[0]
+
+        return SynthesizeAnswersEvent(responses=responses, query_str=query_str, streamed=streamed)
+
+    @step(pass_context=True)
+    async def synthesize_response(self, ctx: Context, ev: SynthesizeAnswersEvent) -> StopEvent:
         """Synthesizes response."""
         responses = ev.responses
         query_str = ev.query_str
 
         # Collecter les sources
-        sources = []
-        for resp in responses:
-            if hasattr(resp, 'source_nodes'):
-                for node in resp.source_nodes:
-                    print("this is metadata",node.metadata)
-                    source = {
-                        'file_name': node.metadata.get('file_name', 'Unknown'),
-                        'url': node.metadata.get('url', 'Unknown'),
-                        'page': node.metadata.get('page_number', 'N/A'),
-                        'content': node.text 
-                    }
-                    sources.append(source)
-                    
+        # NodeWithScore.metadata is a property: read it once per node
+        sources = [
+            {
+                'file_name': metadata.get('file_name', 'Unknown'),
+                'url': metadata.get('url', 'Unknown'),
+                'page': metadata.get('page_number', 'N/A'),
+                'content': node.text
+            }
+            for resp in responses if hasattr(resp, 'source_nodes')
+            for node in resp.source_nodes
+            for metadata in (node.metadata,)
+        ]
+        sources_blob = orjson.dumps(sources, default=str).decode()
+
         # Formater la réponse
         if len(responses) == 1:
-            response = responses[0]
+            response = self._response_text(responses[0])
+            if not ev.streamed:
+                ctx.write_event_to_stream(ResponseDeltaEvent(delta=response))
         else:
-            response_strs = [str(r) for r in responses]
-            response = self.summarizer.get_response(
+            response_strs = [self._response_text(r) for r in responses]
+            response_gen = await self.summarizer.aget_response(
                 query_str, 
                 response_strs,
                 include_metadata=True
             )
+            if isinstance(response_gen, str):
+                response = response_gen
+                ctx.write_event_to_stream(ResponseDeltaEvent(delta=response))
+            else:
+                # streaming summarizer: forward tokens as they are generated
+                deltas = []
+                async for delta in response_gen:
+                    deltas.append(delta)
+                    ctx.write_event_to_stream(ResponseDeltaEvent(delta=delta))
+                response = "".join(deltas)
 
         # Formater la réponse finale
         final_response = (
             f"Réponse à votre question : {query_str}\n\n"
             f"<response>\n"
-            f"{str(response)}\n"
+            f"{response}\n"
             f"</response>\n\n"
             f"<source>\n"
-            f"{sources}\n"
+            f"{sources_blob}\n"
             f"</source>\n\n"
         )
         
@@ -3,9 +3,11 @@ from llama_index.embeddings.openai import OpenAIEmbedding
 from llama_index.vector_stores.supabase import SupabaseVectorStore
 from supabase import create_client
 from parser import Parser
+from indexer import EMBED_DIMENSIONS
 
 from dotenv import load_dotenv
 import os
+import weakref
 
 load_dotenv()
 
@@ -21,36 +23,56 @@ class TreeIndexer:
         self.vector_store = SupabaseVectorStore(
             postgres_connection_string=self.SUPABASE_CONNECTION_STRING,
             collection_name="base_demo",
+            dimension=EMBED_DIMENSIONS,
         )
         
         self.storage_context = StorageContext.from_defaults(vector_store=self.vector_store)
+        # node_id -> display label, per index
+        self._labels = weakref.WeakKeyDictionary()
         
 
+    def _build_labels(self, index):
+        """Computes every node label once, instead of going through the docstore per printed node"""
+        labels = self._labels[index] = {
+            node_id: metadata['file_name'] + ':' + str(metadata['page_number']) if metadata else "Special_nodes"
+            for node_id, doc in index.docstore.docs.items()
+            for metadata in (doc.metadata,)
+        }
+        return labels
+
     def get_node_name(self, index, node_id):
         """Returns the node name if metadata exists, otherwise a fallback label"""
-        metadata = index.docstore.docs[node_id].metadata
-        if metadata and len(metadata) > 0:
-            return metadata['file_name'] + ':' + str(metadata['page_number'])
-        return "Special_nodes"
+        labels = self._labels.get(index)
+        if labels is None:
+            labels = self._build_labels(index)
+        return labels[node_id]
 
     def print_tree(self, index, node_id, prefix="", is_last=True):
+        # Local references avoid repeated attribute lookups in the loop
         tree = index.index_struct.node_id_to_children_ids
-        # For the root call, print a special "Root" label.
-        branch = "└── " if is_last else "├── "
-        print(prefix + branch + self.get_node_name(index, node_id))
+        get_node_name = self.get_node_name
+        # Explicit stack instead of recursion: deep trees can't hit the recursion limit
+        stack = [(node_id, prefix, is_last)]
+        while stack:
+            node_id, prefix, is_last = stack.pop()
+            # For the root call, print a special "Root" label.
+            branch = "└── " if is_last else "├── "
+            print("".join((prefix, branch, get_node_name(index, node_id))))
 
-        children = tree.get(node_id, [])
-        # Prepare the new prefix for children: if current node is last, use spaces; otherwise, use a vertical line.
-        new_prefix = prefix + ("  " if is_last else "│   ")
-        for i, child in enumerate(children):
-            # Determine if the child is the last one in its group.
-            self.print_tree(index, child, new_prefix, i == len(children) - 1)
+            children = tree.get(node_id, [])
+            # Prepare the new prefix for children: if current node is last, use spaces; otherwise, use a vertical line.
+            new_prefix = prefix + ("  " if is_last else "│   ")
+            # Push in reverse so children are printed in their original order
+            last = len(children) - 1
+            for i in range(last, -1, -1):
+                stack.append((children[i], new_prefix, i == last))
 
     def retrieve_index(self):
         # Retrieve the index from the storage context
         index = TreeIndex.from_vector_store(
             vector_store=self.vector_store
         )
+        self._build_labels(index)
         print("✅ Index successfully retrieved from Supabase!")
         return index
 
@@ -60,6 +82,7 @@ class TreeIndexer:
             storage_context=self.storage_context, 
             include_metadata=True
         )
+        self._build_labels(index)
         print("✅ Documents successfully embedded and stored in Supabase!")
         return index
 